@@ -14,7 +14,12 @@ from tqdm import tqdm
 
 from scimilarity.src.scimilarity.cell_embedding import CellEmbedding
 from scimilarity.src.scimilarity.ontologies import import_cell_ontology, get_id_mapper
-from scimilarity.src.scimilarity.utils import check_dataset, lognorm_counts, align_dataset
+from scimilarity.src.scimilarity.utils import (
+    check_dataset,
+    lognorm_counts,
+    align_dataset,
+    normalize_embeddings,
+)
 from scimilarity.src.scimilarity.zarr_dataset import ZarrDataset
 
 
@@ -28,6 +33,9 @@ class CellAnnotation(CellEmbedding):
         parameters: Optional[dict] = None,
         filenames: Optional[dict] = None,
         residual: bool = False,
+        compile_model: bool = False,
+        half_precision: bool = False,
+        knn_backend: str = "hnswlib",
     ):
         """Constructor.
 
@@ -43,6 +51,12 @@ class CellAnnotation(CellEmbedding):
             Use a dictionary of custom filenames for model files instead default.
         residual: bool, default: False
             Use residual connections.
+        compile_model: bool, default: False
+            Compile the model with torch.compile for GPU inference.
+        half_precision: bool, default: False
+            Run inference in reduced precision (bfloat16 or float16).
+        knn_backend: str, default: "hnswlib"
+            The library the kNN index was saved with, either "hnswlib" or "faiss".
 
         Examples
         --------
@@ -55,6 +69,8 @@ class CellAnnotation(CellEmbedding):
             parameters=parameters,
             filenames=filenames,
             residual=residual,
+            compile_model=compile_model,
+            half_precision=half_precision,
         )
 
         if filenames is None:
@@ -68,7 +84,7 @@ class CellAnnotation(CellEmbedding):
         )
 
         # get knn
-        self.load_knn_index(self.filenames["knn"])
+        self.load_knn_index(self.filenames["knn"], backend=knn_backend)
 
         # get int2label
         with open(self.filenames["celltype_labels"], "r") as fh:
@@ -86,6 +102,7 @@ class CellAnnotation(CellEmbedding):
         ef_construction: int = 1000,
         M: int = 80,
         target_labels: Optional[List[str]] = None,
+        backend: str = "hnswlib",
     ):
         """Build and save a kNN index from a h5ad data file or directory of aligned.zarr stores.
 
@@ -108,6 +125,9 @@ class CellAnnotation(CellEmbedding):
             See https://github.com/nmslib/hnswlib/blob/master/ALGO_PARAMS.md
         target_labels: Optional[List[str]], default: None
             Optional list of cell type names to filter the data.
+        backend: str, default: "hnswlib"
+            The library used to build the index, either "hnswlib" or "faiss".
+            Blocklists and safelists are only supported with "hnswlib".
 
         Examples
         --------
@@ -165,15 +185,30 @@ class CellAnnotation(CellEmbedding):
 
         # save knn
         n_cells, n_dims = embeddings.shape
-        self.knn = hnswlib.Index(space="cosine", dim=n_dims)
-        self.knn.init_index(max_elements=n_cells, ef_construction=ef_construction, M=M)
-        self.knn.set_ef(ef_construction)
-        self.knn.add_items(embeddings, range(len(embeddings)))
+        if backend == "faiss":
+            import faiss
+
+            self.knn = faiss.IndexHNSWFlat(n_dims, M, faiss.METRIC_INNER_PRODUCT)
+            self.knn.hnsw.efConstruction = ef_construction
+            self.knn.add(normalize_embeddings(embeddings))
+        elif backend == "hnswlib":
+            self.knn = hnswlib.Index(space="ip", dim=n_dims)
+            self.knn.init_index(
+                max_elements=n_cells, ef_construction=ef_construction, M=M
+            )
+            self.knn.set_ef(ef_construction)
+            self.knn.add_items(normalize_embeddings(embeddings), range(len(embeddings)))
+        else:
+            raise ValueError(f"Unknown kNN backend {backend}.")
+        self.knn_backend = backend
 
         knn_fullpath = os.path.join(self.model_path, knn_filename)
         if os.path.isfile(knn_fullpath):  # backup existing
             os.rename(knn_fullpath, knn_fullpath + ".bak")
-        self.knn.save_index(knn_fullpath)
+        if backend == "faiss":
+            faiss.write_index(self.knn, knn_fullpath)
+        else:
+            self.knn.save_index(knn_fullpath)
 
         # save labels
         celltype_labels_fullpath = os.path.join(
@@ -199,6 +234,11 @@ class CellAnnotation(CellEmbedding):
         >>> ca.reset_kNN()
         """
 
+        if self.knn_backend != "hnswlib":
+            raise ValueError(
+                f"Resetting the kNN is only supported by hnswlib indexes, not {self.knn_backend}."
+            )
+
         # hnswlib does not have a marked status, so we need to unmark all
         for i in self.idx2label:
             try:  # throws an expection if not already marked
@@ -225,6 +265,11 @@ class CellAnnotation(CellEmbedding):
         >>> ca.blocklist_celltypes(["T cell"])
         """
 
+        if self.knn_backend != "hnswlib":
+            raise ValueError(
+                f"Blocklists are only supported by hnswlib indexes, not {self.knn_backend}."
+            )
+
         self.blocklist = set(labels) if isinstance(labels, list) else labels
         self.safelist = None
         self.reset_kNN()
@@ -252,6 +297,11 @@ class CellAnnotation(CellEmbedding):
         >>> ca.safelist_celltypes(["CD4-positive, alpha-beta T cell"])
         """
 
+        if self.knn_backend != "hnswlib":
+            raise ValueError(
+                f"Safelists are only supported by hnswlib indexes, not {self.knn_backend}."
+            )
+
         self.blocklist = None
         self.safelist = set(labels) if isinstance(labels, list) else labels
         for i in range(len(self.idx2label)):  # mark all
@@ -334,6 +384,9 @@ class CellAnnotation(CellEmbedding):
         else:
             predictions = []
             for nns, d_nns in tqdm(zip(nn_idxs, nn_dists), total=nn_idxs.shape[0]):
+                # faiss pads with -1 ids when fewer than k neighbors are found
+                found = nns >= 0
+                nns, d_nns = nns[found], d_nns[found]
                 # count celltype in nearest neighbors (optionally with distance weights)
                 celltype = defaultdict(float)
                 celltype_weighted = defaultdict(float)
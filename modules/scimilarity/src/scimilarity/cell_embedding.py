@@ -1,4 +1,3 @@
-import json
 import os
 from typing import Optional, Tuple, Union
 
@@ -6,12 +5,17 @@ import hnswlib
 import numpy as np
 import pandas as pd
 import torch
-import zarr
+import torch.nn.functional as F
 from scipy.sparse import csr_matrix
 
 from scimilarity.src.scimilarity.b_colors import BColors
 from scimilarity.src.scimilarity.nn_models import Encoder
-from scimilarity.src.scimilarity.utils import align_dataset
+from scimilarity.src.scimilarity.utils import (
+    align_dataset,
+    normalize_embeddings,
+    read_gene_order,
+    read_model_parameters,
+)
 
 
 class CellEmbedding:
@@ -24,6 +28,8 @@ class CellEmbedding:
         parameters: Optional[dict] = None,
         filenames: Optional[dict] = None,
         residual: bool = False,
+        compile_model: bool = False,
+        half_precision: bool = False,
     ):
         """Constructor.
 
@@ -39,6 +45,15 @@ class CellEmbedding:
             Use a dictionary of custom filenames for model files instead default.
         residual: bool, default: False
             Use residual connections.
+        compile_model: bool, default: False
+            Compile the model with torch.compile for GPU inference. The first
+            embedding call is slower while the model compiles, and batches are
+            padded to buffer_size, so keep buffer_size fixed across calls.
+            Requires torch>=2.0.
+        half_precision: bool, default: False
+            Run inference in reduced precision: bfloat16 (float16 if unsupported)
+            weights on GPU, bfloat16 autocast on CPU. Embeddings are returned as
+            float32 and differ slightly from full precision ones.
 
         Examples
         --------
@@ -48,6 +63,7 @@ class CellEmbedding:
         self.model_path = model_path
         self.use_gpu = use_gpu
         self.knn = None
+        self.knn_backend = "hnswlib"
 
         if filenames is None:
             filenames = {}
@@ -61,24 +77,15 @@ class CellEmbedding:
             ),
         }
 
-        # get gene order
-        with open(self.filenames["gene_order"], "r") as fh:
-            self.gene_order = [line.strip() for line in fh]
+        # get gene order, the index can be passed to align_dataset directly
+        self.gene_index = read_gene_order(self.filenames["gene_order"])
+        self.gene_order = self.gene_index.tolist()
 
         # get neural network model
         if parameters is None:  # infer network size if not explicitly given
-            with open(os.path.join(self.model_path, "layer_sizes.json"), "r") as fh:
-                layer_sizes = json.load(fh)
-            # keys: network.1.weight, network.2.weight, ..., network.n.weight
-            layers = [
-                (key, layer_sizes[key])
-                for key in sorted(list(layer_sizes.keys()))
-                if "weight" in key and len(layer_sizes[key]) > 1
-            ]
-            parameters = {
-                "latent_dim": layers[-1][1][0],  # last
-                "hidden_dim": [layer[1][0] for layer in layers][0:-1],  # all but last
-            }
+            parameters = read_model_parameters(
+                os.path.join(self.model_path, "layer_sizes.json")
+            )
 
         self.n_genes = len(self.gene_order)
         self.latent_dim = parameters["latent_dim"]
@@ -93,21 +100,74 @@ class CellEmbedding:
         self.model.load_state(self.filenames["model"])
         self.model.eval()
 
+        self.half_precision = half_precision
+        self.dtype = torch.float32  # dtype of the model inputs
+        if self.half_precision is True and self.use_gpu is True:
+            self.dtype = (
+                torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            )
+            self.model.to(dtype=self.dtype)
+
+        # the model used by get_embeddings, self.model stays the plain Encoder
+        self.inference_model = self.model
+        self.compile_model = False
+        if compile_model is True and self.use_gpu is True:
+            if hasattr(torch, "compile"):
+                self.inference_model = torch.compile(
+                    self.model, mode="reduce-overhead", fullgraph=True
+                )
+                self.compile_model = True
+            else:
+                print(
+                    f"{BColors.WARNING}Warning: torch.compile requires torch>=2.0, the model is not compiled{BColors.ENDC}"
+                )
+
+        # both are pandas Series, which support the same lookups as dicts
         self.int2label = pd.read_csv(
-            os.path.join(self.model_path, "label_ints.csv"), index_col=0
-        )["0"].to_dict()
-        self.label2int = {value: key for key, value in self.int2label.items()}
+            os.path.join(self.model_path, "label_ints.csv"),
+            index_col=0,
+            dtype={"0": "category"},
+            keep_default_na=False,
+        )["0"]
+        self.label2int = pd.Series(
+            self.int2label.index, index=self.int2label.to_numpy()
+        )
 
-    def load_knn_index(self, knn_file: str):
+    def load_knn_index(self, knn_file: str, backend: str = "hnswlib"):
         """Load the kNN index file
 
         Parameters
         ----------
         knn_file: str
             Filename of the kNN index.
+        backend: str, default: "hnswlib"
+            The library the index was saved with, either "hnswlib" or "faiss".
+            A faiss index must be an inner product index of unit length vectors.
+            With use_gpu, faiss indexes that support it are moved to the GPU.
         """
-        if os.path.isfile(knn_file):
-            self.knn = hnswlib.Index(space="cosine", dim=self.model.latent_dim)
+        if backend not in ["hnswlib", "faiss"]:
+            raise ValueError(f"Unknown kNN backend {backend}.")
+
+        self.knn_backend = backend
+        if os.path.isfile(knn_file) and backend == "faiss":
+            import faiss
+
+            self.knn = faiss.read_index(knn_file)
+            if self.use_gpu is True and hasattr(faiss, "StandardGpuResources"):
+                try:
+                    # the resources must outlive the GPU index
+                    self.knn_gpu_resources = faiss.StandardGpuResources()
+                    self.knn = faiss.index_cpu_to_gpu(
+                        self.knn_gpu_resources, 0, self.knn
+                    )
+                except RuntimeError:  # e.g. HNSW indexes have no GPU version
+                    print(
+                        f"{BColors.WARNING}Warning: kNN index at {knn_file} cannot be moved to the GPU{BColors.ENDC}"
+                    )
+        elif os.path.isfile(knn_file):
+            # indexes hold unit length vectors (cosine indexes normalize on insert),
+            # so inner product search on normalized queries gives cosine distances
+            self.knn = hnswlib.Index(space="ip", dim=self.model.latent_dim)
             self.knn.load_index(knn_file)
         else:
             print(
@@ -120,6 +180,7 @@ class CellEmbedding:
         X: Union[csr_matrix, np.ndarray],
         num_cells: int = -1,
         buffer_size: int = 10000,
+        out_path: Optional[str] = None,
     ) -> np.ndarray:
         """Calculate embeddings for lognormed gene expression matrix.
 
@@ -132,11 +193,15 @@ class CellEmbedding:
             A value of -1 will embed all cells.
         buffer_size: int, default: 10000
             The number of cells to embed in one batch.
+        out_path: str, optional
+            Write the embeddings to a float32 numpy.memmap file at this path instead
+            of keeping them in memory, for datasets with millions of cells.
 
         Returns
         -------
         numpy.ndarray
             A 2D numpy array of embeddings [num_cells x latent_space_dimensions].
+            A numpy.memmap if out_path is given.
 
         Examples
         --------
@@ -147,55 +212,155 @@ class CellEmbedding:
 
         if num_cells == -1:
             num_cells = X.shape[0]
+        if num_cells == 0:
+            raise RuntimeError(f"No valid cells detected.")
 
-        if (
-            isinstance(X, csr_matrix)
-            and (
-                isinstance(X.data, zarr.core.Array)
-                or isinstance(X.indices, zarr.core.Array)
-                or isinstance(X.indptr, zarr.core.Array)
+        if isinstance(X, csr_matrix):
+            # load the row pointers once, so that data and indices (which may be
+            # zarr arrays) are read with one contiguous slice per batch
+            indptr = np.asarray(X.indptr[...])
+
+        # a compiled model sees every batch padded to buffer_size, so that calls
+        # with different numbers of cells reuse the same compiled graph
+        batch_rows = min(buffer_size, num_cells)
+        if self.compile_model is True:
+            batch_rows = buffer_size
+        if self.use_gpu is True and isinstance(X, csr_matrix):
+            # sparse batches are densified on the device, reusing one buffer
+            dense_buffer = torch.empty(
+                (batch_rows, X.shape[1]), dtype=self.dtype, device="cuda"
             )
-            and num_cells <= buffer_size
+        elif self.use_gpu is True and not (
+            isinstance(X, torch.Tensor) and X.is_cuda
         ):
-            X.data = X.data[...]
-            X.indices = X.indices[...]
-            X.indptr = X.indptr[...]
-
-        embedding_parts = []
+            # two pinned staging buffers, so that the next batch is filled on the
+            # host while the previous one is still being copied to the device
+            staging = [
+                torch.empty((batch_rows, X.shape[1]), dtype=self.dtype, pin_memory=True)
+                for _ in range(2)
+            ]
+            staging_free = [None, None]
+        if self.use_gpu is True:
+            # embeddings are copied back asynchronously into pinned buffers and
+            # written out one batch later, so the host never waits on the model
+            host_out = [
+                torch.empty((batch_rows, self.latent_dim), pin_memory=True)
+                for _ in range(2)
+            ]
+            out_ready = [None, None]
+            pending = None  # (slot, start, stop) of the batch being copied back
+
+        if out_path is not None:
+            embedding = np.memmap(
+                out_path,
+                dtype=np.float32,
+                mode="w+",
+                shape=(num_cells, self.latent_dim),
+            )
+        else:
+            embedding = np.empty((num_cells, self.latent_dim), dtype=np.float32)
+        # flag kept on the device, so that checking a batch does not synchronize
+        nan_found = torch.zeros(
+            (), dtype=torch.bool, device="cuda" if self.use_gpu is True else "cpu"
+        )
         with torch.inference_mode():  # disable gradients, not needed for inference
             for i in range(0, num_cells, buffer_size):
+                stop = min(i + buffer_size, num_cells)
                 profiles = None
                 if isinstance(X, np.ndarray):
-                    profiles = torch.Tensor(X[i : i + buffer_size])
+                    profiles = torch.from_numpy(X[i:stop])
                 elif isinstance(X, torch.Tensor):
-                    profiles = X[i : i + buffer_size]
+                    profiles = X[i:stop]
+                elif isinstance(X, csr_matrix) and self.use_gpu is True:
+                    # only the nonzero entries are sent to the device
+                    lo, hi = indptr[i], indptr[stop]
+                    row_lengths = torch.from_numpy(np.diff(indptr[i : stop + 1]))
+                    # output_size is known on the host, avoiding a device sync
+                    rows = torch.repeat_interleave(
+                        torch.arange(stop - i, device="cuda"),
+                        row_lengths.to("cuda", non_blocking=True),
+                        output_size=int(hi - lo),
+                    )
+                    cols = torch.from_numpy(X.indices[lo:hi].astype(np.int64))
+                    values = torch.from_numpy(np.asarray(X.data[lo:hi]))
+                    profiles = dense_buffer[: stop - i]
+                    profiles.zero_()
+                    # accumulate so duplicate entries sum, as in toarray()
+                    profiles.index_put_(
+                        (rows, cols.to("cuda", non_blocking=True)),
+                        values.to("cuda", dtype=profiles.dtype, non_blocking=True),
+                        accumulate=True,
+                    )
                 elif isinstance(X, csr_matrix):
-                    profiles = torch.Tensor(X[i : i + buffer_size].toarray())
+                    lo, hi = indptr[i], indptr[stop]
+                    batch = csr_matrix(
+                        (X.data[lo:hi], X.indices[lo:hi], indptr[i : stop + 1] - lo),
+                        shape=(stop - i, X.shape[1]),
+                    )
+                    profiles = torch.from_numpy(batch.toarray())
 
                 if profiles is None:
                     raise RuntimeError(f"Unknown data type {type(X)}.")
 
+                slot = (i // buffer_size) % 2
+                if self.use_gpu is True and not profiles.is_cuda:
+                    if staging_free[slot] is not None:
+                        staging_free[slot].synchronize()
+                    buffer = staging[slot][: profiles.shape[0]]
+                    buffer.copy_(profiles)
+                    profiles = buffer.to("cuda", non_blocking=True)
+                    staging_free[slot] = torch.cuda.Event()
+                    staging_free[slot].record()
+                else:
+                    profiles = profiles.to(self.dtype)
+                n = stop - i
+                if self.compile_model is True and n < batch_rows:
+                    # pad the last batch to the compiled shape to avoid recompiling
+                    profiles = F.pad(profiles, (0, 0, 0, batch_rows - n))
+
+                # write each batch straight into the output array
+                with torch.autocast(
+                    "cpu",
+                    dtype=torch.bfloat16,
+                    enabled=self.half_precision is True and self.use_gpu is False,
+                ):
+                    batch_embedding = self.inference_model(profiles)[:n]
+                nan_found |= torch.isnan(batch_embedding).any()
                 if self.use_gpu is True:
-                    profiles = profiles.cuda()
-                embedding_parts.append(self.model(profiles))
-
-        if not embedding_parts:
-            raise RuntimeError(f"No valid cells detected.")
-
-        if self.use_gpu:
-            # detach, move from gpu into cpu, return as numpy array
-            embedding = torch.vstack(embedding_parts).detach().cpu().numpy()
-        else:
-            # detach, return as numpy array
-            embedding = torch.vstack(embedding_parts).detach().numpy()
-
-        if np.isnan(embedding).any():
+                    host_out[slot][:n].copy_(batch_embedding.float(), non_blocking=True)
+                    out_ready[slot] = torch.cuda.Event()
+                    out_ready[slot].record()
+                    if pending is not None:
+                        self._write_back(embedding, host_out, out_ready, *pending)
+                    pending = (slot, i, stop)
+                else:
+                    embedding[i:stop] = batch_embedding.float().numpy()
+
+            if self.use_gpu is True:
+                self._write_back(embedding, host_out, out_ready, *pending)
+
+        if nan_found.item():
+            if out_path is not None:
+                del embedding
+                os.remove(out_path)
             raise RuntimeError(f"NaN detected in embeddings.")
 
+        if out_path is not None:
+            embedding.flush()
+
         return embedding
 
+    def _write_back(self, embedding, host_out, out_ready, slot, start, stop):
+        # wait for the asynchronous copy of one batch, then store it
+        out_ready[slot].synchronize()
+        embedding[start:stop] = host_out[slot][: stop - start].numpy()
+
     def get_nearest_neighbors(
-        self, embeddings: np.ndarray, k: int = 50, ef: int = 100
+        self,
+        embeddings: np.ndarray,
+        k: int = 50,
+        ef: int = 100,
+        buffer_size: int = 10000,
     ) -> Tuple[np.ndarray, np.ndarray]:
         """Get nearest neighbors.
         Used by classes that inherit from CellEmbedding and have an instantiated kNN.
@@ -209,13 +374,17 @@ class CellEmbedding:
         ef: int, default: 100
             The size of the dynamic list for the nearest neighbors.
             See https://github.com/nmslib/hnswlib/blob/master/ALGO_PARAMS.md
+            Only used by HNSW indexes.
+        buffer_size: int, default: 10000
+            The number of cells to normalize and query at a time, so that memory
+            mapped embeddings are not loaded into memory at once.
 
         Returns
         -------
         nn_idxs: numpy.ndarray
             A 2D numpy array of nearest neighbor indices [num_cells x k].
         nn_dists: numpy.ndarray
-            A 2D numpy array of nearest neighbor distances [num_cells x k].
+            A 2D numpy array of nearest neighbor cosine distances [num_cells x k].
 
         Examples
         --------
@@ -229,5 +398,33 @@ class CellEmbedding:
             raise RuntimeError(
                 "kNN is not initialized. If no kNN index file is found, run the method build_knn."
             )
-        self.knn.set_ef(ef)
-        return self.knn.knn_query(embeddings, k=k)
+
+        if self.knn_backend == "faiss":
+            if hasattr(self.knn, "hnsw"):
+                self.knn.hnsw.efSearch = ef
+        else:
+            self.knn.set_ef(ef)
+
+        embeddings = np.asarray(embeddings)  # no copy for arrays and memmaps
+        nn_idxs = None
+        # an empty query still runs once, returning empty arrays as before
+        for i in range(0, max(embeddings.shape[0], 1), buffer_size):
+            batch = normalize_embeddings(embeddings[i : i + buffer_size])
+            if self.knn_backend == "faiss":
+                similarities, batch_idxs = self.knn.search(batch, k)
+                batch_dists = 1.0 - similarities
+            else:
+                batch_idxs, batch_dists = self.knn.knn_query(
+                    batch, k=k, num_threads=-1
+                )
+            if nn_idxs is None:
+                nn_idxs = np.empty(
+                    (embeddings.shape[0], batch_idxs.shape[1]), dtype=batch_idxs.dtype
+                )
+                nn_dists = np.empty(
+                    (embeddings.shape[0], batch_dists.shape[1]),
+                    dtype=batch_dists.dtype,
+                )
+            nn_idxs[i : i + buffer_size] = batch_idxs
+            nn_dists[i : i + buffer_size] = batch_dists
+        return nn_idxs, nn_dists
@@ -26,6 +26,9 @@ class CellQuery(CellEmbedding):
         embedding_tiledb_uri: str = "cell_embedding",
         residual: bool = False,
         load_knn: bool = True,
+        compile_model: bool = False,
+        half_precision: bool = False,
+        knn_backend: str = "hnswlib",
     ):
         """Constructor.
 
@@ -49,6 +52,12 @@ class CellQuery(CellEmbedding):
             Use residual connections.
         load_knn: bool, default: True
             Load the knn index. Set to False if knn search is not needed.
+        compile_model: bool, default: False
+            Compile the model with torch.compile for GPU inference.
+        half_precision: bool, default: False
+            Run inference in reduced precision (bfloat16 or float16).
+        knn_backend: str, default: "hnswlib"
+            The library the kNN index was saved with, either "hnswlib" or "faiss".
 
         Examples
         --------
@@ -61,6 +70,8 @@ class CellQuery(CellEmbedding):
             parameters=parameters,
             filenames=filenames,
             residual=residual,
+            compile_model=compile_model,
+            half_precision=half_precision,
         )
         self.cellsearch_path = cellsearch_path
 
@@ -76,7 +87,7 @@ class CellQuery(CellEmbedding):
 
         # get knn
         if load_knn:
-            self.load_knn_index(self.filenames["knn"])
+            self.load_knn_index(self.filenames["knn"], backend=knn_backend)
         self.block_list = set()
 
         # get cell metadata: create tiledb storage if it does not exist
@@ -446,14 +457,16 @@ class CellQuery(CellEmbedding):
             new_nn_idxs = []
             new_nn_dists = []
             for row in range(nn_idxs.shape[0]):
-                hits = nn_dists[row] <= max_dist
+                hits = (nn_dists[row] <= max_dist) & (nn_idxs[row] >= 0)
                 new_nn_idxs.append(nn_idxs[row, hits])
                 new_nn_dists.append(nn_dists[row, hits])
             nn_idxs = new_nn_idxs
             nn_dists = new_nn_dists
         else:
-            nn_idxs = [row for row in nn_idxs]
-            nn_dists = [row for row in nn_dists]
+            # faiss pads with -1 ids when fewer than k neighbors are found
+            found = nn_idxs >= 0
+            nn_idxs = [row[hits] for row, hits in zip(nn_idxs, found)]
+            nn_dists = [row[hits] for row, hits in zip(nn_dists, found)]
 
         if exclude_studies:
             study_index = self.cell_metadata["study"].values
@@ -10,7 +10,7 @@ import torch
 from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
 
 from scimilarity.src.scimilarity.ontologies import import_cell_ontology, get_id_mapper
-from scimilarity.src.scimilarity.utils import align_dataset
+from scimilarity.src.scimilarity.utils import align_dataset, read_gene_order
 
 
 class scDataset(Dataset):
@@ -95,8 +95,7 @@ class MetricLearningDataModule(pl.LightningDataModule):
         if (
             gene_order_file is not None
         ):  # gene space needs be aligned to the given gene order
-            with open(gene_order_file, "r") as fh:
-                self.gene_order = [line.strip() for line in fh]
+            self.gene_order = read_gene_order(gene_order_file).tolist()
             train_data = align_dataset(train_data, self.gene_order)
         else:  # training dataset gene space is the gene order
             self.gene_order = train_data.var.index.tolist()
@@ -12,6 +12,7 @@ from torch import nn
 
 from scimilarity.src.scimilarity.triplet_selector import TripletSelector
 from scimilarity.src.scimilarity.nn_models import Decoder, Encoder
+from scimilarity.src.scimilarity.utils import normalize_embeddings
 
 
 class TripletLoss(torch.nn.TripletMarginLoss):
@@ -434,13 +435,15 @@ class MetricLearning(pl.LightningModule):
     ):
         n_cells, latent_dim = embeddings.shape
         nn_reference = hnswlib.Index(
-            space="cosine", dim=latent_dim
-        )  # possible options are l2, cosine, or ip
+            space="ip", dim=latent_dim
+        )  # possible options are l2, cosine, or ip; ip on unit vectors is cosine
         nn_reference.init_index(
             max_elements=n_cells, ef_construction=ef_construction, M=M
         )
         nn_reference.set_ef(ef_construction)
-        nn_reference.add_items(embeddings, range(len(embeddings)))
+        nn_reference.add_items(
+            normalize_embeddings(embeddings), range(len(embeddings))
+        )
         return nn_reference
 
     def save_all(
@@ -1,3 +1,6 @@
+import functools
+import json
+import os
 from typing import Optional, Tuple, Union
 
 import anndata
@@ -9,6 +12,76 @@ from numba import njit
 from scipy.sparse import csr_matrix
 
 
+def read_gene_order(filename: str) -> pd.Index:
+    """Read a gene order file, with one gene symbol per line.
+
+    Parameters
+    ----------
+    filename: str
+        Path to the gene order file.
+
+    Returns
+    -------
+    pandas.Index
+        An index of the gene symbols in file order.
+
+    Notes
+    -----
+    The result is cached for as long as the file is not modified.
+
+    Examples
+    --------
+    >>> gene_index = read_gene_order("/opt/data/model/gene_order.tsv")
+    """
+    return _read_gene_order(filename, os.path.getmtime(filename))
+
+
+@functools.lru_cache(maxsize=8)
+def _read_gene_order(filename: str, mtime: float) -> pd.Index:
+    with open(filename, "r") as fh:
+        return pd.Index([line.strip() for line in fh])
+
+
+def read_model_parameters(filename: str) -> dict:
+    """Infer the encoder network size from a layer sizes file.
+
+    Parameters
+    ----------
+    filename: str
+        Path to the layer sizes json file of a model.
+
+    Returns
+    -------
+    dict
+        A dictionary with the "latent_dim" and "hidden_dim" model parameters.
+
+    Notes
+    -----
+    The file is parsed once for as long as it is not modified.
+
+    Examples
+    --------
+    >>> parameters = read_model_parameters("/opt/data/model/layer_sizes.json")
+    """
+    latent_dim, hidden_dim = _read_model_parameters(
+        filename, os.path.getmtime(filename)
+    )
+    return {"latent_dim": latent_dim, "hidden_dim": list(hidden_dim)}
+
+
+@functools.lru_cache(maxsize=8)
+def _read_model_parameters(filename: str, mtime: float) -> Tuple[int, tuple]:
+    with open(filename, "r") as fh:
+        layer_sizes = json.load(fh)
+    # keys: network.1.weight, network.2.weight, ..., network.n.weight
+    sizes = [
+        layer_sizes[key][0]
+        for key in sorted(layer_sizes)
+        if "weight" in key and len(layer_sizes[key]) > 1
+    ]
+    return sizes[-1], tuple(sizes[:-1])  # last, all but last
+
+
 def check_dataset(
     data: Union[anndata.AnnData, pgio.UnimodalData, pgio.MultimodalData],
     target_gene_order: np.ndarray,
@@ -335,7 +408,7 @@ def align_dataset(
     ----------
     data: pegasusio.MultimodalData, pegasusio.UnimodalData, anndata.AnnData
         Annotated data matrix with rows for cells and columns for genes.
-    target_gene_order: numpy.ndarray
+    target_gene_order: numpy.ndarray, pandas.Index
         An array containing the gene space.
     keep_obsm: bool, default: False
         Retain the original data's obsm matrices in output.
@@ -356,8 +429,10 @@ def align_dataset(
     if isinstance(data, pgio.MultimodalData):
         data = data.get_data(data.list_data()[0])
 
+    target_gene_order = pd.Index(target_gene_order)
+
     # raise an error if not enough genes from target_gene_order exists
-    if sum(data.var.index.isin(target_gene_order)) < gene_overlap_threshold:
+    if data.var.index.isin(target_gene_order).sum() < gene_overlap_threshold:
         raise RuntimeError(
             f"Dataset incompatible: gene overlap less than {gene_overlap_threshold}. Check that var.index uses gene symbols."
         )
@@ -367,7 +442,7 @@ def align_dataset(
         raise RuntimeError(f"Dataset contains negative values in expression matrix X.")
 
     # return data if already aligned
-    if data.var.index.values.tolist() == target_gene_order:
+    if data.var.index.equals(target_gene_order):
         return data
 
     shell = None
@@ -376,7 +451,7 @@ def align_dataset(
         obs_field = data.obs
         var_field = pd.DataFrame(index=target_gene_order)
 
-        indexer = var_field.index.get_indexer(data.var_names)
+        indexer = target_gene_order.get_indexer(data.var_names)
         new_size = (indexer[mat.indices] >= 0).sum()
         data_new, indices_new, indptr_new = select_csr(
             mat.data, mat.indices, mat.indptr, indexer, new_size
@@ -440,6 +515,28 @@ def align_dataset(
     return shell
 
 
+def normalize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    """Scale embeddings to unit length, so their inner product is cosine similarity.
+
+    Parameters
+    ----------
+    embeddings: numpy.ndarray
+        A 2D numpy array of embeddings [num_cells x latent_space_dimensions].
+
+    Returns
+    -------
+    numpy.ndarray
+        A 2D numpy array of unit length embeddings in float32.
+
+    Examples
+    --------
+    >>> embeddings = normalize_embeddings(ce.get_embeddings(data.X))
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-30)
+
+
 def get_centroid(sparse_counts_mat: csr_matrix) -> np.ndarray:
     """Get the centroid for a raw counts matrix in scipy.sparse.csr_matrix format.
 
@@ -1,14 +1,18 @@
+import hashlib
+import json
 import os
-from collections import Counter
+import tempfile
 
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 import pytorch_lightning as pl
 import torch
 from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
 from tqdm import tqdm
-from typing import Optional
+from typing import Optional, Union
 
+from scimilarity.src.scimilarity.utils import read_gene_order
 from scimilarity.src.scimilarity.zarr_dataset import ZarrDataset
 
 
@@ -32,25 +36,100 @@ class scDatasetFromList(Dataset):
         self.obs_celltype = obs_celltype
         self.obs_study = obs_study
 
-        self.data_idx = [
-            n for n in range(len(self.ncells_list)) for i in range(self.ncells_list[n])
-        ]
-        self.cell_idx = [
-            i for n in range(len(self.ncells_list)) for i in range(self.ncells_list[n])
+        # read the obs columns once instead of on every item access
+        self.celltype_cache = [
+            np.asarray(data.get_obs(obs_celltype)) for data in data_list
         ]
+        self.study_cache = [np.asarray(data.get_obs(obs_study)) for data in data_list]
+
+        # flat index -> (dataset, cell) lookup, stored as contiguous arrays
+        self.data_idx = np.repeat(
+            np.arange(len(self.ncells_list), dtype=np.int32), self.ncells_list
+        )
+        self.cell_idx = (
+            np.concatenate([np.arange(n, dtype=np.int32) for n in self.ncells_list])
+            if self.ncells_list
+            else np.empty(0, dtype=np.int32)
+        )
 
     def __len__(self):
         return self.ncells
 
     def __getitem__(self, idx):
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indices):
+        # data, label, study for a whole batch, used by DataLoader in torch>=2.1
+        indices = np.asarray(indices)
+        data_idx = self.data_idx[indices]
+        cell_idx = self.cell_idx[indices]
+
+        # group the batch by dataset so that each dataset is sliced only once,
+        # writing every group straight into its block of the profiles; cells are
+        # sorted within a group so that each slice reads increasing coordinates
+        order = np.lexsort((cell_idx, data_idx))
+        bounds = np.flatnonzero(np.diff(data_idx[order])) + 1
+        profiles = np.empty((len(indices), self.data_list[0].shape[1]), np.float32)
+        for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(indices)]):
+            group = order[start:stop]
+            data = self.data_list[data_idx[group[0]]]
+            data.get_rows(cell_idx[group], out=profiles[start:stop])
+
+        rows = np.argsort(order)  # position of each batch item in profiles
+        return [
+            (
+                profiles[rows[i]],
+                self.celltype_cache[data_idx[i]][cell_idx[i]],
+                self.study_cache[data_idx[i]][cell_idx[i]],
+            )
+            for i in range(len(indices))
+        ]
+
+
+class MemmapDataset(Dataset):
+    """A class to encapsulate a dense on-disk copy of single cell datasets"""
+    def __init__(self, filename, shape, labels, studies, dtype=np.float16):
+        """Constructor.
+
+        Parameters
+        ----------
+        filename: str
+            Path to the dense matrix file, as written by
+            MetricLearningZarrDataModule.materialize_dense.
+        shape: Tuple[int, int]
+            The shape of the dense matrix [ncells x ngenes].
+        labels: pandas.Categorical
+            Cell type name for each cell.
+        studies: pandas.Categorical
+            Study name for each cell.
+        dtype: numpy.dtype, default: numpy.float16
+            The data type of the dense matrix file.
+        """
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.labels = labels
+        self.studies = studies
+        self.dtype = dtype
+        self.data = None  # opened on first access, so workers map it themselves
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indices):
         # data, label, study
-        data_idx = self.data_idx[idx]
-        cell_idx = self.cell_idx[idx]
-        return (
-            self.data_list[data_idx].get_cell(cell_idx).A,
-            self.data_list[data_idx].get_obs(self.obs_celltype)[cell_idx],
-            self.data_list[data_idx].get_obs(self.obs_study)[cell_idx],
-        )
+        if self.data is None:
+            self.data = np.memmap(
+                self.filename, dtype=self.dtype, mode="r", shape=self.shape
+            )
+        indices = np.asarray(indices)
+        profiles = self.data[indices].astype(np.float32)
+        return [
+            (profiles[i], self.labels[idx], self.studies[idx])
+            for i, idx in enumerate(indices)
+        ]
 
 
 class MetricLearningZarrDataModule(pl.LightningDataModule):
@@ -64,6 +143,7 @@ class MetricLearningZarrDataModule(pl.LightningDataModule):
         obs_field: str = "celltype_name",
         batch_size: int = 1000,
         num_workers: int = 1,
+        dense_path: Optional[str] = None,
     ):
         """Constructor.
 
@@ -86,6 +166,13 @@ class MetricLearningZarrDataModule(pl.LightningDataModule):
             Batch size.
         num_workers: int, default: 1
             The number of worker threads for dataloaders
+        dense_path: str, optional
+            Train from a dense float16 copy of the training data at this path
+            instead of densifying the sparse zarr rows of every batch. The file is
+            created in prepare_data if it does not exist and checked against the
+            training data in setup otherwise. It needs ncells x ngenes x 2 bytes
+            of disk.
+            Only worthwhile for moderately sparse data.
 
         Examples
         --------
@@ -104,16 +191,15 @@ class MetricLearningZarrDataModule(pl.LightningDataModule):
         self.test_path = test_path
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.dense_path = dense_path
 
         # gene space needs be aligned to the given gene order
-        with open(gene_order, "r") as fh:
-            self.gene_order = [line.strip() for line in fh]
+        self.gene_index = read_gene_order(gene_order)
+        self.gene_order = self.gene_index.tolist()
 
         self.n_genes = len(self.gene_order)  # used when creating training model
 
         train_data_list = []
-        self.train_Y = []  # text labels
-        self.train_study = []  # text studies
         self.train_file_list = [
             f for f in os.listdir(self.train_path) if f.endswith(".aligned.zarr")
         ]
@@ -122,21 +208,25 @@ class MetricLearningZarrDataModule(pl.LightningDataModule):
             if os.path.isdir(data_path):
                 zarr_data = ZarrDataset(data_path)
                 train_data_list.append(zarr_data)
-                self.train_Y.extend(zarr_data.get_obs(obs_field).astype(str).tolist())
-                self.train_study.extend(zarr_data.get_obs("study").astype(str).tolist())
 
         # Lazy load training data from list of zarr datasets
-        self.train_dataset = scDatasetFromList(train_data_list)
+        self.train_dataset = scDatasetFromList(train_data_list, obs_celltype=obs_field)
+        # text labels and studies, stored as categoricals
+        self.train_Y = self.concat_obs(self.train_dataset.celltype_cache)
+        self.train_study = self.concat_obs(self.train_dataset.study_cache)
+        # labels are fixed, so sampler weights are computed once for all epochs
+        self.train_sample_weights = torch.from_numpy(
+            self.get_sample_weights(self.train_Y, self.train_study)
+        )
 
-        self.class_names = set(self.train_Y)
+        self.class_names = set(self.train_Y.categories)
         self.label2int = {label: i for i, label in enumerate(self.class_names)}
         self.int2label = {value: key for key, value in self.label2int.items()}
+        self.label_index = pd.Index(list(self.label2int))  # positions are label ints
 
         self.val_dataset = None
         if self.val_path is not None:
             val_data_list = []
-            self.val_Y = []
-            self.val_study = []
             self.val_file_list = [
                 f for f in os.listdir(self.val_path) if f.endswith(".aligned.zarr")
             ]
@@ -145,19 +235,18 @@ class MetricLearningZarrDataModule(pl.LightningDataModule):
                 if os.path.isdir(data_path):
                     zarr_data = ZarrDataset(data_path)
                     val_data_list.append(zarr_data)
-                    self.val_Y.extend(zarr_data.get_obs(obs_field).astype(str).tolist())
-                    self.val_study.extend(
-                        zarr_data.get_obs("study").astype(str).tolist()
-                    )
 
             # Lazy load val data from list of zarr datasets
-            self.val_dataset = scDatasetFromList(val_data_list)
+            self.val_dataset = scDatasetFromList(val_data_list, obs_celltype=obs_field)
+            self.val_Y = self.concat_obs(self.val_dataset.celltype_cache)
+            self.val_study = self.concat_obs(self.val_dataset.study_cache)
+            self.val_sample_weights = torch.from_numpy(
+                self.get_sample_weights(self.val_Y, self.val_study)
+            )
 
         self.test_dataset = None
         if self.test_path is not None:
             test_data_list = []
-            self.test_Y = []
-            self.test_study = []
             self.test_file_list = [
                 f for f in os.listdir(self.test_path) if f.endswith(".aligned.zarr")
             ]
@@ -166,48 +255,216 @@ class MetricLearningZarrDataModule(pl.LightningDataModule):
                 if os.path.isdir(data_path):
                     zarr_data = ZarrDataset(data_path)
                     test_data_list.append(zarr_data)
-                    self.test_Y.extend(
-                        zarr_data.get_obs(obs_field).astype(str).tolist()
-                    )
-                    self.test_study.extend(
-                        zarr_data.get_obs("study").astype(str).tolist()
-                    )
 
             # Lazy load test data from list of zarr datasets
-            self.test_dataset = scDatasetFromList(test_data_list)
+            self.test_dataset = scDatasetFromList(
+                test_data_list, obs_celltype=obs_field
+            )
+            self.test_Y = self.concat_obs(self.test_dataset.celltype_cache)
+            self.test_study = self.concat_obs(self.test_dataset.study_cache)
+            self.test_sample_weights = torch.from_numpy(
+                self.get_sample_weights(self.test_Y, self.test_study)
+            )
+
+    def prepare_data(self):
+        # called on a single process, before setup is called on every process
+        if self.dense_path is not None and not os.path.isfile(self.dense_path):
+            self.materialize_dense(self.dense_path)
+
+    def setup(self, stage: Optional[str] = None):
+        if self.dense_path is not None and not isinstance(
+            self.train_dataset, MemmapDataset
+        ):
+            self.check_dense(self.dense_path)
+            self.train_dataset = MemmapDataset(
+                self.dense_path,
+                (self.train_dataset.ncells, self.n_genes),
+                self.train_Y,
+                self.train_study,
+            )
+
+    def dense_metadata(self, dtype=np.float16) -> dict:
+        # describes the training data a dense copy was written from, including
+        # values that change when the zarr stores are rewritten in place
+        return {
+            "shape": [int(self.train_dataset.ncells), self.n_genes],
+            "dtype": np.dtype(dtype).name,
+            "train_path": os.path.abspath(self.train_path),
+            "train_file_list": self.train_file_list,
+            "gene_order_sha1": hashlib.sha1(
+                "\n".join(self.gene_order).encode()
+            ).hexdigest(),
+            "train_stores": [
+                self.store_fingerprint(data) for data in self.train_dataset.data_list
+            ],
+        }
+
+    def store_fingerprint(self, data: ZarrDataset) -> dict:
+        # shape, number of stored values and modification time of the matrix
+        X = data.root["X"]
+        array = "indptr" if "indptr" in X else "data"
+        return {
+            "shape": list(data.shape),
+            "nnz": int(X["data"].shape[0]),
+            "mtime": os.path.getmtime(os.path.join(data.store_path.path, "X", array)),
+        }
+
+    def check_dense(self, filename: str, dtype=np.float16):
+        """Check that a dense matrix file matches the training data.
+
+        Parameters
+        ----------
+        filename: str
+            Path to the dense matrix file.
+        dtype: numpy.dtype, default: numpy.float16
+            The data type of the dense matrix.
+
+        Examples
+        --------
+        >>> datamodule.check_dense("train.float16.dat")
+        """
+
+        metadata_file = filename + ".json"
+        if not os.path.isfile(metadata_file):
+            raise RuntimeError(
+                f"No metadata found for dense matrix {filename}, it may be incomplete. Delete it to rebuild."
+            )
+        with open(metadata_file, "r") as fh:
+            metadata = json.load(fh)
+        if metadata != self.dense_metadata(dtype):
+            raise RuntimeError(
+                f"Dense matrix {filename} was written from different training data. Delete it to rebuild."
+            )
+        ncells, n_genes = metadata["shape"]
+        expected_size = ncells * n_genes * np.dtype(dtype).itemsize
+        if os.path.getsize(filename) != expected_size:
+            raise RuntimeError(
+                f"Dense matrix {filename} has {os.path.getsize(filename)} bytes, expected {expected_size}. Delete it to rebuild."
+            )
+
+    def materialize_dense(
+        self, filename: str, dtype=np.float16, buffer_size: int = 10000
+    ):
+        """Write the training data to disk as a dense matrix.
+
+        The matrix is written to a temporary file that is moved into place once
+        complete, followed by a json file describing the training data it holds.
+
+        Parameters
+        ----------
+        filename: str
+            Path to the dense matrix file.
+        dtype: numpy.dtype, default: numpy.float16
+            The data type of the dense matrix.
+        buffer_size: int, default: 10000
+            The number of cells to densify at a time.
+
+        Examples
+        --------
+        >>> datamodule.materialize_dense("train.float16.dat")
+        """
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        # mkstemp creates files readable by the owner only, use the umask default
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+
+        fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            dense = np.memmap(
+                tmp_filename,
+                dtype=dtype,
+                mode="w+",
+                shape=(self.train_dataset.ncells, self.n_genes),
+            )
+            buffer = np.empty((buffer_size, self.n_genes), dtype=np.float32)
+            offset = 0
+            for data in tqdm(self.train_dataset.data_list):
+                for i in range(0, data.shape[0], buffer_size):
+                    stop = min(i + buffer_size, data.shape[0])
+                    rows = data.get_rows(np.arange(i, stop), out=buffer[: stop - i])
+                    dense[offset + i : offset + stop] = rows
+                offset += data.shape[0]
+            dense.flush()
+            del dense
+            os.chmod(tmp_filename, mode)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+
+        fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as fh:
+                json.dump(self.dense_metadata(dtype), fh)
+            os.chmod(tmp_filename, mode)
+            os.replace(tmp_filename, filename + ".json")
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+
+    def concat_obs(self, values_list: list) -> pd.Categorical:
+        # text values encoded as categorical codes, one entry per cell
+        if not values_list:
+            return pd.Categorical([])
+        return union_categoricals(
+            [pd.Categorical(np.asarray(values).astype(str)) for values in values_list]
+        )
 
     def two_way_weighting(self, vec1: list, vec2: list):
         counts = pd.crosstab(vec1, vec2)
         weights_matrix = (1 / counts).replace(np.inf, 0)
         return weights_matrix.unstack().to_dict()
 
-    def get_sampler_weights(self, labels: list, studies: Optional[list] = None):
-        if studies is None:
-            class_sample_count = Counter(labels)
-            sample_weights = torch.Tensor([1.0 / class_sample_count[t] for t in labels])
-        else:
-            class_sample_count = Counter(labels)
-            study_sample_count = Counter(studies)
-            sample_weights = torch.Tensor(
-                [
-                    1.0
-                    / class_sample_count[labels[i]]
-                    / np.log(study_sample_count[studies[i]])
-                    for i in range(len(labels))
-                ]
-            )
-        return WeightedRandomSampler(sample_weights, len(sample_weights))
+    def get_sample_weights(
+        self,
+        labels: Union[list, pd.Categorical],
+        studies: Optional[Union[list, pd.Categorical]] = None,
+    ) -> np.ndarray:
+        # inverse label frequency, damped by the log of the study size
+        label_codes = pd.Categorical(labels).codes
+        sample_weights = 1.0 / np.bincount(label_codes)[label_codes]
+        if studies is not None:
+            study_codes = pd.Categorical(studies).codes
+            sample_weights /= np.log(np.bincount(study_codes)[study_codes])
+        return sample_weights
+
+    def get_sampler_weights(
+        self,
+        labels: Union[list, pd.Categorical],
+        studies: Optional[Union[list, pd.Categorical]] = None,
+    ):
+        sample_weights = self.get_sample_weights(labels, studies)
+        return WeightedRandomSampler(
+            torch.from_numpy(sample_weights), len(sample_weights), replacement=True
+        )
 
     def collate(self, batch):
         profiles, labels, studies = tuple(
             map(list, zip(*batch))
         )  # tuple([list(t) for t in zip(*batch)])
+
+        label_ints = self.label_index.get_indexer(labels)  # text to int labels
+        if (label_ints < 0).any():
+            raise KeyError(f"Unknown labels {set(np.asarray(labels)[label_ints < 0])}.")
+
+        # copy the rows straight into the batch tensor
+        batch_profiles = torch.empty((len(profiles), self.n_genes), dtype=torch.float32)
+        np.stack(profiles, out=batch_profiles.numpy())
         return (
-            torch.squeeze(torch.Tensor(np.vstack(profiles))),
-            torch.Tensor([self.label2int[l] for l in labels]),  # text to int labels
+            torch.squeeze(batch_profiles),
+            torch.Tensor(label_ints),
             studies,
         )
 
+    def worker_options(self) -> dict:
+        # keep workers alive across epochs and let each prefetch a few batches
+        if self.num_workers == 0:
+            return {}
+        return {"persistent_workers": True, "prefetch_factor": 4}
+
     def train_dataloader(self):
         return DataLoader(
             self.train_dataset,
@@ -215,8 +472,11 @@ class MetricLearningZarrDataModule(pl.LightningDataModule):
             num_workers=self.num_workers,
             pin_memory=True,
             drop_last=True,
-            sampler=self.get_sampler_weights(self.train_Y, self.train_study),
+            sampler=WeightedRandomSampler(
+                self.train_sample_weights, len(self.train_sample_weights)
+            ),
             collate_fn=self.collate,
+            **self.worker_options(),
         )
 
     def val_dataloader(self):
@@ -228,8 +488,11 @@ class MetricLearningZarrDataModule(pl.LightningDataModule):
             num_workers=self.num_workers,
             pin_memory=True,
             drop_last=True,
-            sampler=self.get_sampler_weights(self.val_Y, self.val_study),
+            sampler=WeightedRandomSampler(
+                self.val_sample_weights, len(self.val_sample_weights)
+            ),
             collate_fn=self.collate,
+            **self.worker_options(),
         )
 
     def test_dataloader(self):
@@ -241,6 +504,9 @@ class MetricLearningZarrDataModule(pl.LightningDataModule):
             num_workers=self.num_workers,
             pin_memory=True,
             drop_last=True,
-            sampler=self.get_sampler_weights(self.test_Y, self.test_study),
+            sampler=WeightedRandomSampler(
+                self.test_sample_weights, len(self.test_sample_weights)
+            ),
             collate_fn=self.collate,
+            **self.worker_options(),
         )
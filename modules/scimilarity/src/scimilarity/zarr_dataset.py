@@ -5,6 +5,7 @@ import numpy as np
 import pandas as pd
 import zarr
 from scipy.sparse import csr_matrix, csc_matrix, coo_matrix
+from scipy.sparse import vstack as sparse_vstack
 
 ARRAY_FORMATS = {
     "csr_matrix": csr_matrix,
@@ -41,6 +42,8 @@ class ZarrDataset:
         self.root = zarr.open_group(
             self.store_path, mode=mode, chunk_store=self.store_path
         )
+        self.indptr_cache = {}  # in memory indptr of read-only groups, by path
+        self.mode = mode
 
     @property
     def dataset_info(self) -> Dict[str, list]:
@@ -325,6 +328,68 @@ class ZarrDataset:
             )
         return None
 
+    def get_cells(self, idx: Union[List[int], np.ndarray]) -> csr_matrix:
+        """Get gene expression data for multiple cells as sparse matrix.
+
+        Parameters
+        ----------
+        idx: Union[List[int], numpy.ndarray],
+            Numerical indices of the cells.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            A sparse matrix with one row per cell, in the order given by idx.
+
+        Examples
+        --------
+        >>> zarr_data.get_cells([4, 8, 15, 16, 23, 42])
+        """
+
+        if "X" in self.root.keys():
+            X = self.root["X"]
+            encoding_type = X.attrs["encoding-type"]
+
+            if encoding_type == "csr_matrix":
+                return self.rows_slice_csr(X, idx)
+            elif encoding_type == "coo_matrix":
+                return self.rows_slice_coo(X, idx)
+            raise RuntimeError(
+                f"Unsupported encoding-type for multi-row slicing: {encoding_type}."
+            )
+        return None
+
+    def get_rows(
+        self, idx: Union[List[int], np.ndarray], out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Get gene expression data for multiple cells as dense matrix.
+
+        Parameters
+        ----------
+        idx: Union[List[int], numpy.ndarray],
+            Numerical indices of the cells.
+        out: numpy.ndarray, optional
+            A C-contiguous array of shape [len(idx) x ngenes] to write the data into.
+
+        Returns
+        -------
+        numpy.ndarray
+            A dense matrix with one row per cell, in the order given by idx.
+
+        Examples
+        --------
+        >>> zarr_data.get_rows([4, 8, 15, 16, 23, 42])
+        """
+
+        mtx = self.get_cells(idx)
+        if mtx is None:
+            return None
+        if out is None:
+            return mtx.toarray()
+        mtx.data = mtx.data.astype(out.dtype, copy=False)
+        out.fill(0)
+        return mtx.toarray(out=out)
+
     def get_layer_cell(self, layer_key: str, idx: int) -> Union[csr_matrix, csc_matrix]:
         """Get data for one cell from a layer as sparse matrix.
 
@@ -443,6 +508,48 @@ class ZarrDataset:
         shape = group.attrs["shape"]
         return csr_matrix((new_data, new_indices, new_indptr), shape=(1, shape[1]))
 
+    def rows_slice_csr(self, group, idx: Union[List[int], np.ndarray]) -> csr_matrix:
+        data = group["data"]
+        indices = group["indices"]
+        shape = group.attrs["shape"]
+
+        idx = np.asarray(idx, dtype=np.int64)
+        if self.mode == "r":
+            # the row pointers are small and fixed, so keep them in memory
+            if group.path not in self.indptr_cache:
+                self.indptr_cache[group.path] = group["indptr"][...]
+            indptr = self.indptr_cache[group.path]
+            starts = indptr[idx]
+            stops = indptr[idx + 1]
+        else:
+            indptr = group["indptr"]
+            starts = indptr.get_coordinate_selection(idx)
+            stops = indptr.get_coordinate_selection(idx + 1)
+        lengths = stops - starts
+
+        new_indptr = np.zeros(len(idx) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=new_indptr[1:])
+        nnz = new_indptr[-1]
+        if nnz == 0:
+            return csr_matrix((len(idx), shape[1]), dtype=data.dtype)
+
+        # positions of every stored value of the requested rows, in row order
+        coords = np.repeat(starts - new_indptr[:-1], lengths) + np.arange(nnz)
+        new_data = data.get_coordinate_selection(coords)
+        new_indices = indices.get_coordinate_selection(coords)
+        return csr_matrix(
+            (new_data, new_indices, new_indptr), shape=(len(idx), shape[1])
+        )
+
+    def rows_slice_coo(self, group, idx: Union[List[int], np.ndarray]) -> csr_matrix:
+        # coo_matrix stores have no row pointers, so slice one row at a time
+        shape = group.attrs["shape"]
+        if len(idx) == 0:
+            return csr_matrix((0, shape[1]), dtype=group["data"].dtype)
+        return sparse_vstack(
+            [self.slice_coo(group, i, axis=0) for i in idx], format="csr"
+        )
+
     def col_slice_csc(self, group: csc_matrix, idx: int) -> csc_matrix:
         new_data, new_indices, new_indptr = self.slice_with(group, idx)
         shape = group.attrs["shape"]